@@ -1,32 +1,362 @@
+# extractor.py
+import io, os, re, time, asyncio, hashlib, tempfile
+from itertools import islice
+import orjson
+import pandas as pd
+import pymupdf as fitz
 import pdfplumber
+from pdf2image import convert_from_bytes
 
-def extract_from_pdf(file_path):
+# Pages and files are OCR'd in parallel; tesseract's own OpenMP threads (up to
+# 4 per process by default) would only oversubscribe the cores. Set before any
+# tesseract is spawned, and inherited by pool workers.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+def init_worker():
+    # pool initializer; a top-level function so it pickles under spawn too
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+def _ocr_limit(concurrency=None):
+    # per-PDF tesseract/poppler parallelism. Callers running several PDFs at
+    # once pass each one's share of the cores; OCR_CONCURRENCY overrides both.
+    env = os.getenv("OCR_CONCURRENCY")
+    if env:
+        return max(1, int(env))
+    return max(1, concurrency or os.cpu_count() or 1)
+
+# ---------- Regex helpers ----------
+DATE_RE   = re.compile(r'(\b\d{1,2}[\/\-]\d{1,2}[\/\-]\d{2,4}\b)|(\b\d{4}[\/\-]\d{1,2}[\/\-]\d{1,2}\b)')
+GSTIN_RE  = re.compile(r'\b[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z]{1}[1-9A-Z]{1}Z[0-9A-Z]{1}\b', re.I)
+INVNO_RE  = re.compile(r'(?i)(invoice\s*(no|number|#)[:\s]*)([A-Z0-9\-/]+)')
+INVTYPE_RE= re.compile(r'(?i)\b(Tax Invoice|Credit Note|Debit Note|Bill of Supply)\b')
+# one item per line: description, qty, rate, amount separated by 2+ spaces.
+# All three numbers are required so "CGST @ 9%  9  2.30"-style tax/total lines
+# don't pass as items; digit groups ("1,000", "1,00,000") are allowed.
+ITEM_LINE_RE = re.compile(
+    r'^[ \t]*(?P<desc>\S.*?)[ \t]{2,}(?P<qty>\d[\d,]*(?:\.\d+)?)[ \t]{2,}(?P<rate>\d[\d,]*(?:\.\d{1,2})?)'
+    r'[ \t]{2,}(?P<amt>\d[\d,]*(?:\.\d{1,2})?)[ \t\r]*$', re.M)
+
+# ---------- Output columns ----------
+HEADER_COLS = ["source_file", "invoice_number", "invoice_date", "invoice_type", "supplier_gstin", "customer_gstin"]
+ITEM_COLS   = ["item_description", "quantity", "unit_price", "taxable_value"]
+COL_ORDER   = HEADER_COLS + ITEM_COLS
+
+# ---------- OCR settings ----------
+MIN_TEXT_CHARS = 20  # less machine-readable text than this and we OCR instead
+OCR_DPI = 150  # enough for typed invoices; raise for poor scans
+OCR_OEM = 1    # LSTM engine only
+OCR_PSM = 6    # assume a single uniform block of text, as on invoice pages
+OCR_CONFIG = [("tessedit_do_invert", "0")]  # skip the inverted-text pass
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", "tesseract")
+
+# ---------- Table header keywords ----------
+ITEM_HEADER_KEYS = ("description", "item", "hsn", "qty", "quantity", "rate", "amount", "taxable", "value")
+# column aliases, already whitespace-stripped and lowercased for find_columns
+COL_ALIASES = {
+    "desc": ("description", "item", "particular"),
+    "qty":  ("qty", "quantity"),
+    "rate": ("rate", "unitprice", "price"),
+    "taxv": ("taxablevalue", "value", "amount"),
+}
+
+def extract_text_fast(pdf_bytes: bytes, max_pages=None):
+    # MuPDF's native text extraction; much faster than pdfminer for plain text
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        n = min(doc.page_count, max_pages or doc.page_count)
+        first_text = doc.load_page(0).get_text("text") if n else ""
+        # no text layer on page 1 means a scan: hand it to OCR without
+        # reading the remaining pages
+        if len(first_text.strip()) < MIN_TEXT_CHARS:
+            return []
+        return [first_text] + [doc.load_page(i).get_text("text") for i in range(1, n)]
+
+def extract_tables(pdf_bytes: bytes, page_texts=None):
+    # pdfplumber is kept only for tables, where its layout analysis matters.
+    # Layout analysis is its most expensive step, so when the page texts are
+    # known only pages mentioning an item-table header keyword are opened.
+    pages = None
+    if page_texts is not None:
+        pages = [n for n, txt in enumerate(page_texts, start=1)
+                 if any(k in txt.lower() for k in ITEM_HEADER_KEYS)]
+        if not pages:
+            return []
+    tables_meta = []
+    # BytesIO over an immutable bytes object shares its buffer (no second copy);
+    # leaving the with-block closes the PDF and drops pdfminer's caches.
+    with pdfplumber.open(io.BytesIO(pdf_bytes), pages=pages) as pdf:
+        for page in pdf.pages:
+            tbs = page.extract_tables()
+            if tbs:
+                for t in tbs:
+                    tables_meta.append({"page": page.page_number, "table": t})
+            # drop this page's chars/layout objects now rather than at close,
+            # so memory stays at about one page however long the PDF is
+            page.close()
+    return tables_meta
+
+async def _tesseract_list(paths, out_base, lang, dpi):
+    # tesseract treats a non-image input as a list of image paths, so the
+    # model is loaded once for every page in the list
+    lst = out_base + "_list.txt"
+    with open(lst, "w", encoding="utf-8") as f:
+        f.write("\n".join(paths) + "\n")
+    args = [TESSERACT_CMD, lst, out_base, "-l", lang, "--oem", str(OCR_OEM), "--psm", str(OCR_PSM), "--dpi", str(dpi)]
+    for k, v in OCR_CONFIG:
+        args += ["-c", f"{k}={v}"]
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.PIPE)
+    _, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"tesseract exited with {proc.returncode}: {err.decode(errors='replace').strip()}")
+    with open(out_base + ".txt", encoding="utf-8") as f:
+        pages = f.read().split("\f")  # tesseract ends every page with a form feed
+    if pages and pages[-1] == "":
+        pages.pop()
+    return pages
+
+async def _ocr_batches(batches, workdir, lang, dpi):
+    return await asyncio.gather(*(_tesseract_list(paths, os.path.join(workdir, f"out{i}"), lang, dpi)
+                                  for i, paths in enumerate(batches)))
+
+def ocr_text_from_pdf(pdf_bytes: bytes, lang="eng", dpi=OCR_DPI, max_pages=None, concurrency=None):
+    limit = _ocr_limit(concurrency)
+    with tempfile.TemporaryDirectory() as d:
+        # greyscale at a modest DPI: tesseract time scales with pixel count.
+        # Poppler rasterises on `limit` threads and writes the pages straight
+        # to disk for tesseract to read.
+        paths = convert_from_bytes(pdf_bytes, dpi=dpi, grayscale=True, thread_count=limit,
+                                   fmt="jpeg", jpegopt={"quality": 85, "optimize": True},
+                                   first_page=1 if max_pages else None, last_page=max_pages,
+                                   output_folder=d, paths_only=True)
+        if not paths:
+            return ""
+        # up to OCR_CONCURRENCY tesseract processes, each OCR'ing a contiguous
+        # run of pages from one list file
+        size = -(-len(paths) // limit)
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+        pages = [p for batch in asyncio.run(_ocr_batches(batches, d, lang, dpi)) for p in batch]
+    return "\n\n".join(pages)
+
+def parse_invoice_header(text: str, filename: str):
+    out = {
+        "source_file": filename,
+        "invoice_number": "",
+        "invoice_date": "",
+        "invoice_type": "",
+        "supplier_gstin": "",
+        "customer_gstin": ""
+    }
+    m = INVNO_RE.search(text)
+    out["invoice_number"] = (m.group(3).strip() if m else filename.rsplit(".",1)[0])
+    md = DATE_RE.search(text)
+    out["invoice_date"] = md.group(0) if md else ""
+    mt = INVTYPE_RE.search(text)
+    out["invoice_type"] = mt.group(1) if mt else ""
+    # only supplier and customer are used; stop scanning after the second
+    gstins = [g.group(0) for g in islice(GSTIN_RE.finditer(text), 2)]
+    if gstins:
+        out["supplier_gstin"] = gstins[0]
+        if len(gstins) > 1: out["customer_gstin"] = gstins[1]
+    return out
+
+def table_has_items(table):
+    if not table or not table[0]:
+        return False
+    header = " ".join([str(c).lower() for c in table[0] if c])
+    return any(k in header for k in ITEM_HEADER_KEYS)
+
+def normalize_table(table):
+    return [[("" if c is None else str(c).strip()) for c in row] for row in table]
+
+def find_columns(header):
+    """Maps each COL_ALIASES field to the first header column containing one of its aliases."""
+    cols = {}
+    for i, col in enumerate(header):
+        key = "".join(col.split())  # normalised once per column, not once per field
+        for field, aliases in COL_ALIASES.items():
+            if field not in cols and any(a in key for a in aliases):
+                cols[field] = i
+        if len(cols) == len(COL_ALIASES):
+            break
+    return cols
+
+def map_table_to_items(table):
+    """Best-effort mapping. Customize per vendor as needed."""
+    t = normalize_table(table)
+    # crude column guesses
+    # try to locate common columns by fuzzy match
+    cols = find_columns([h.lower() for h in t[0]])
+    col_desc = cols.get("desc")
+    col_qty  = cols.get("qty")
+    col_rate = cols.get("rate")
+    col_taxv = cols.get("taxv")
+
+    items = [{
+        "item_description": row[col_desc] if col_desc is not None and col_desc < len(row) else (row[1] if len(row)>1 else ""),
+        "quantity":         row[col_qty]  if col_qty  is not None and col_qty  < len(row) else "",
+        "unit_price":       row[col_rate] if col_rate is not None and col_rate < len(row) else "",
+        "taxable_value":    row[col_taxv] if col_taxv is not None and col_taxv < len(row) else ""
+    } for row in t[1:] if any(row)]
+    if not items:
+        items = [{"item_description":"", "quantity":"", "unit_price":"", "taxable_value":""}]
+    return items
+
+# ---------- Content-hash cache ----------
+# Streamlit reruns the whole script on every widget interaction; keying the
+# expensive text/table extraction on the PDF's SHA1 makes a rerun over the same
+# batch a file read per invoice. Lives on disk so pool workers share it.
+# Entries hold full invoice text, so the cache is bounded in age and size;
+# set INVOICE_EXTRACTOR_CACHE="" to turn it off.
+CACHE_DIR = os.getenv("INVOICE_EXTRACTOR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "invoice-extractor"))
+CACHE_TTL = 3600          # seconds
+CACHE_MAX_ENTRIES = 256
+EXTRACT_VERSION = 2       # bump whenever extraction output changes, to orphan old entries
+
+def _cache_path(pdf_hash: str, force_ocr: bool, lang: str, dpi: int, max_pages):
+    mode = "ocr" if force_ocr else "auto"
+    lang = re.sub(r'[^\w+]', '_', lang)
+    return os.path.join(CACHE_DIR, f"v{EXTRACT_VERSION}.{pdf_hash}.{mode}.{lang}.{dpi}.{max_pages or 'all'}.json")
+
+def _prune_cache():
+    # drop expired entries, then the oldest beyond CACHE_MAX_ENTRIES
+    now = time.time()
+    entries = []
+    with os.scandir(CACHE_DIR) as it:
+        for e in it:
+            if not e.name.endswith(".json"):
+                continue
+            try:
+                mtime = e.stat().st_mtime
+            except OSError:
+                continue
+            if now - mtime > CACHE_TTL:
+                _remove_quietly(e.path)
+            else:
+                entries.append((mtime, e.path))
+    entries.sort(reverse=True)
+    for _, path in entries[CACHE_MAX_ENTRIES:]:
+        _remove_quietly(path)
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # another worker got there first
+
+def load_cached(pdf_hash: str, force_ocr: bool, lang: str, dpi: int, max_pages):
+    if not CACHE_DIR:
+        return None
+    path = _cache_path(pdf_hash, force_ocr, lang, dpi, max_pages)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            _remove_quietly(path)
+            return None
+        with open(path, "rb") as f:
+            d = orjson.loads(f.read())
+        return d["text"], d["tables_meta"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def store_cached(pdf_hash: str, force_ocr: bool, lang: str, dpi: int, max_pages, text: str, tables_meta: list):
+    if not CACHE_DIR:
+        return
+    path = _cache_path(pdf_hash, force_ocr, lang, dpi, max_pages)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        # serialise first: orjson raises JSONEncodeError (a TypeError) on lone
+        # surrogates in OCR/PDF text, and no empty tmp file should be left behind
+        data = orjson.dumps({"text": text, "tables_meta": tables_meta})
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # atomic, so concurrent workers never see a partial file
+        _prune_cache()
+    except (OSError, TypeError):
+        pass  # cache is best-effort
+
+def extract_document(pdf_bytes: bytes, fname: str, force_ocr: bool, ocr_lang: str, ocr_dpi: int = OCR_DPI,
+                     max_pages=None, ocr_concurrency=None):
+    """Returns (text, tables_meta, messages), served from the cache when possible."""
+    h = hashlib.sha1(pdf_bytes).hexdigest()
+    cached = load_cached(h, force_ocr, ocr_lang, ocr_dpi, max_pages)
+    if cached is not None:
+        return cached[0], cached[1], []
+
+    messages = []
+    text, tables_meta = "", []
+    # 1) Machine extraction (PyMuPDF text, pdfplumber tables)
+    if not force_ocr:
+        page_texts = None
+        try:
+            page_texts = extract_text_fast(pdf_bytes, max_pages)
+            text = "\n\n".join(page_texts).strip()
+        except Exception as e:
+            messages.append(("warning", f"{fname}: PyMuPDF failed — {e}"))
+        # scanned PDFs have no text layer and so no tables; skip the layout pass
+        if len(text) >= MIN_TEXT_CHARS:
+            try:
+                tables_meta = extract_tables(pdf_bytes, page_texts)
+            except Exception as e:
+                messages.append(("warning", f"{fname}: pdfplumber failed — {e}"))
+
+    # 2) OCR fallback
+    if (not text or len(text) < MIN_TEXT_CHARS) or force_ocr:
+        try:
+            text = ocr_text_from_pdf(pdf_bytes, lang=ocr_lang, dpi=ocr_dpi, max_pages=max_pages,
+                                     concurrency=ocr_concurrency)
+        except Exception as e:
+            messages.append(("error", f"{fname}: OCR failed — {e}"))
+            text = text or ""  # keep whatever we had
+
+    # failures are not cached so the next rerun retries them
+    if not messages:
+        store_cached(h, force_ocr, ocr_lang, ocr_dpi, max_pages, text, tables_meta)
+    return text, tables_meta, messages
+
+def process_one(pdf_bytes: bytes, fname: str, force_ocr: bool, ocr_lang: str, ocr_dpi: int = OCR_DPI,
+                max_pages=None, ocr_concurrency=None):
     """
-    Dummy extractor:
-    Reads PDF (if possible) and returns structured invoice-like data.
-    Currently returns sample static fields for demo.
+    Runs the full pipeline for one invoice. Top-level and pickle-safe so it can
+    be submitted to a ProcessPoolExecutor; returns (items_df, payload, messages)
+    where items_df holds the invoice's consolidated rows in COL_ORDER and
+    messages are (level, text) pairs for the UI to show.
     """
-    try:
-        with pdfplumber.open(file_path) as pdf:
-            text = pdf.pages[0].extract_text()
-    except:
-        text = ""
-
-    data = {
-        "Invoice_Number": "INV-2025-001",
-        "GSTIN": "27ABCDE1234F1Z5",
-        "Date": "2025-04-01",
-        "Vendor_Name": "ABC Traders Pvt Ltd",
-        "Buyer_Name": "XYZ Enterprises",
-        "Taxable_Value": 50000,
-        "CGST": 4500,
-        "SGST": 4500,
-        "IGST": 0,
-        "Total_Invoice_Value": 59000,
-        "HSN_Code": "9983",
-        "Place_of_Supply": "Maharashtra",
-        "Invoice_Type": "Tax Invoice",
-        "Raw_Text_Extracted": text[:200]
-    }
+    # 1) Machine extraction (PyMuPDF/pdfplumber) + 2) OCR fallback
+    text, tables_meta, messages = extract_document(pdf_bytes, fname, force_ocr, ocr_lang, ocr_dpi, max_pages,
+                                                   ocr_concurrency)
 
-    return data
+    # 3) Parse header
+    header = parse_invoice_header(text, fname)
+
+    # 4) Parse items (prefer tables from pdfplumber)
+    items = []
+    if tables_meta:
+        for tmeta in tables_meta:
+            t = tmeta["table"]
+            if table_has_items(t):
+                items = map_table_to_items(t)
+                break
+    if not items:
+        # basic OCR line heuristic for items (very naive); one scan over the text
+        items = [{
+            "item_description": m["desc"],
+            "quantity": m["qty"],
+            "unit_price": m["rate"],
+            "taxable_value": m["amt"]
+        } for m in ITEM_LINE_RE.finditer(text)]
+    if not items:
+        items = [{"item_description":"", "quantity":"", "unit_price":"", "taxable_value":""}]
+
+    # 5) Collect rows: one small frame per invoice, header broadcast over items
+    items_df = pd.DataFrame(items, columns=ITEM_COLS).fillna("")
+    for k in HEADER_COLS:
+        items_df[k] = header[k]
+    items_df = items_df[COL_ORDER]
+
+    # Per-invoice payload for ZIP (summary + items CSV)
+    payload = {
+        "summary": header,
+        "items": items,
+        "raw_text_snippet": "\n".join(text.splitlines()[:30])
+    }
+    return items_df, payload, messages